@@ -9,28 +9,105 @@ https://github.com/yokoyama-flogics/flux-diffusion-client
 """
 
 import argparse
+import asyncio
+import base64
+import binascii
+import functools
+import hashlib
 import json
+import math
 import os
 import random
+import secrets
+import shutil
 import sys
 import time
-from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
 
-import requests
+import aiohttp
+from aiohttp import web
 from dotenv import find_dotenv, load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # pylint: disable=invalid-name
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None  # pylint: disable=invalid-name
+
 # Constants
 OUTPUT_DIR_NAME = "output"
-POLLING_SLEEP_INTERVAL = 1  # seconds
-REQUESTS_GET_TIMEOUT = 10  # seconds
+CACHE_DIR_NAME = ".cache"
+POLLING_INITIAL_DELAY = 0.5  # seconds
+POLLING_MAX_DELAY = 10  # seconds
+REQUESTS_GET_TIMEOUT = 10  # seconds to connect, and between reads
+LONG_POLL_WAIT = 30  # seconds the server may hold a get_result request
+LONG_POLL_TIMEOUT = 60  # seconds
+# Result statuses meaning the generation is still under way; any other
+# status except "Ready" is final
+POLLING_PENDING_STATUSES = ("Pending", "Processing")
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # bytes
+DOWNLOAD_ATTEMPTS = 3
+DOWNLOAD_RETRY_DELAY = 0.5  # seconds, doubled after each failed attempt
+WEBHOOK_TIMEOUT = 300  # seconds to wait for a webhook before polling
+CONNECTION_LIMIT = 32  # connections in total
+CONNECTION_LIMIT_PER_HOST = 8  # connections to each host
+DNS_CACHE_TTL = 300  # seconds
+KEEPALIVE_TIMEOUT = 75  # seconds
+
+# Request parameters that a job submitted to the server may override
+JOB_OPTION_NAMES = (
+    "width",
+    "height",
+    "variant",
+    "steps",
+    "prompt_upsampling",
+    "seed",
+    "guidance",
+    "safety_tolerance",
+    "interval",
+)
+
+# Default command-line arguments
+DEFAULTS: Dict[str, Any] = {
+    "width": 1024,
+    "height": 1024,
+    "variant": "flux.1-pro",
+    "steps": 25,
+    "prompt_upsampling": False,
+    "seed": "rand",
+    "guidance": 2.5,
+    "safety_tolerance": 2,
+    "interval": 2.0,
+    "batch": 1,
+    "concurrency": 4,
+    "host": "127.0.0.1",
+    "port": 8080,
+}
+
+
+class GenerationError(Exception):
+    """
+    Raised when a single image generation fails.
+    """
 
 
+@functools.lru_cache(maxsize=1)
 def load_api_key() -> str:
     """
-    Load BFL_API_KEY from .env files.
+    Load BFL_API_KEY from the environment, or else from .env files. The key
+    is looked up only once per process.
     """
+    # A key already in the environment needs no .env lookup
+    api_key = os.environ.get("BFL_API_KEY")
+    if api_key:
+        return api_key
+
     # Load .env from the home directory first
     home_env_path = Path.home() / ".env"
     load_dotenv(home_env_path)
@@ -44,9 +121,9 @@ def load_api_key() -> str:
     return api_key
 
 
-def parse_arguments(defaults: Dict[str, Any]) -> argparse.Namespace:
+def build_parser(defaults: Dict[str, Any]) -> argparse.ArgumentParser:
     """
-    Parse command-line arguments.
+    Build the command-line argument parser.
     """
     parser = argparse.ArgumentParser(
         description="Diffusion Model Image Generation Script",
@@ -138,6 +215,70 @@ def parse_arguments(defaults: Dict[str, Any]) -> argparse.Namespace:
             "more diversity."
         ),
     )
+    parser.add_argument(
+        "-n",
+        "--batch",
+        type=int,
+        default=defaults["batch"],
+        help=(
+            "Number of images to generate from the prompt. Each image gets "
+            "its own seed and all of them are generated concurrently."
+        ),
+    )
+    parser.add_argument(
+        "-b",
+        "--batch_file",
+        type=Path,
+        help=(
+            "Read prompts from this file, one per line, instead of a single "
+            "prompt from standard input"
+        ),
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=defaults["concurrency"],
+        help="Maximum number of generations in flight at the same time",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help=(
+            "Run as a long-lived HTTP server accepting generation jobs on "
+            "POST /generate instead of reading a prompt from standard input"
+        ),
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default=defaults["host"],
+        help="Address the server listens on (with --serve)",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=defaults["port"],
+        help="Port the server listens on (with --serve)",
+    )
+    parser.add_argument(
+        "--public_url",
+        type=str,
+        help=(
+            "Base URL at which the FLUX.1 API can reach this server (with "
+            "--serve). When given, results are delivered by webhook "
+            "instead of polling."
+        ),
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help=(
+            "Neither reuse nor cache images. Without it, images generated "
+            "with a fixed integer seed are cached in output/.cache and "
+            "reused for identical requests."
+        ),
+    )
     parser.add_argument(
         "-V",
         "--verbose",
@@ -145,7 +286,25 @@ def parse_arguments(defaults: Dict[str, Any]) -> argparse.Namespace:
         help="Enable verbose output for request and result details",
     )
 
-    return parser.parse_args()
+    return parser
+
+
+# Built once at import time and reused by every parse_arguments() call
+PARSER = build_parser(DEFAULTS)
+
+# Value types of the options a server job may override, as parsed by PARSER
+JOB_OPTION_TYPES = {
+    action.dest: action.type or type(action.default)
+    for action in PARSER._actions  # pylint: disable=protected-access
+    if action.dest in JOB_OPTION_NAMES
+}
+
+
+def parse_arguments(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse command-line arguments.
+    """
+    return PARSER.parse_args(argv)
 
 
 def get_prompt() -> str:
@@ -161,13 +320,38 @@ def get_prompt() -> str:
     return prompt
 
 
+def read_prompts(filepath: Path) -> List[str]:
+    """
+    Read prompts from a batch file, one prompt per non-empty line.
+    """
+    try:
+        lines = filepath.read_text(encoding="utf-8").splitlines()
+    except OSError as e:
+        sys.exit(f"Error: Cannot read batch file: {e}")
+    prompts = [line.strip() for line in lines if line.strip()]
+    if not prompts:
+        sys.exit("Error: Batch file contains no prompts.")
+    return prompts
+
+
 def create_output_directory(directory: Path) -> None:
     """
     Create output directory if it does not exist.
     """
-    if not directory.exists():
+    try:
         directory.mkdir(parents=True)
-        print(f"Created directory: {OUTPUT_DIR_NAME}")
+    except FileExistsError:
+        return
+    print(f"Created directory: {OUTPUT_DIR_NAME}")
+
+
+def generate_stamp() -> str:
+    """
+    Generate the stamp that output filenames start with: the current time
+    plus a short random suffix, so that generations started within the same
+    second never collide.
+    """
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}"
 
 
 def generate_filename(base: str, timestamp: str, extension: str) -> str:
@@ -177,164 +361,351 @@ def generate_filename(base: str, timestamp: str, extension: str) -> str:
     return f"{timestamp}_{base}.{extension}"
 
 
+def encode_json(data: Dict[str, Any]) -> bytes:
+    """
+    Serialize dictionary as pretty-formatted UTF-8 JSON with sorted keys, so
+    that equal dictionaries give equal bytes. The faster orjson is used when
+    installed; the fallback produces the same layout.
+    """
+    if orjson is not None:
+        return orjson.dumps(
+            data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+        )
+    return json.dumps(
+        data, indent=2, sort_keys=True, ensure_ascii=False
+    ).encode("utf-8")
+
+
 def save_json(data: Dict[str, Any], filepath: Path) -> None:
     """
     Save dictionary as pretty-formatted JSON.
     """
-    with filepath.open("w", encoding="utf-8") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+    filepath.write_bytes(encode_json(data))
 
 
-def download_image(url: str, filepath: Path) -> None:
+def cache_path(request_body: bytes) -> Path:
     """
-    Download an image from a URL and save it as JPEG within the output
-    directory.
+    Return the path of the cached image for the given request body, as
+    serialized by encode_json.
+    """
+    key = hashlib.sha256(request_body).hexdigest()
+    return Path.cwd() / OUTPUT_DIR_NAME / CACHE_DIR_NAME / f"{key}.jpg"
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
     """
+    Hard-link src to dst, falling back to a copy where linking fails. The
+    directory of dst is created if needed.
+    """
+    dst.parent.mkdir(parents=True, exist_ok=True)
     try:
-        response = requests.get(url, timeout=REQUESTS_GET_TIMEOUT)
-        response.raise_for_status()
-        # Construct the full path by joining OUTPUT_DIR_NAME and filepath
-        full_path = Path(OUTPUT_DIR_NAME) / filepath
-        with full_path.open("wb") as f:
-            f.write(response.content)
-        print(f"Image saved to {OUTPUT_DIR_NAME}/{filepath.name}")
-    except requests.RequestException as e:
-        print(f"Failed to download image from {url}: {e}")
+        os.link(src, dst)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def create_session(concurrency: int) -> aiohttp.ClientSession:
+    """
+    Create the HTTP session shared by all requests. Its connector caches DNS
+    lookups and keeps idle connections open across polls, while capping how
+    many connections a batch may open. Every one of the concurrency
+    generations in flight can hold a (long-polling) connection to the API,
+    so the per-host cap is raised to at least that many.
+    """
+    limit_per_host = max(CONNECTION_LIMIT_PER_HOST, concurrency)
+    connector = aiohttp.TCPConnector(
+        limit=max(CONNECTION_LIMIT, limit_per_host),
+        limit_per_host=limit_per_host,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+def advertised_md5(response: aiohttp.ClientResponse) -> Optional[bytes]:
+    """
+    Return the MD5 digest of the body given in the Content-MD5 header of the
+    response, or None if the server did not send a valid one.
+    """
+    content_md5 = response.headers.get("Content-MD5")
+    if not content_md5:
+        return None
+    try:
+        return base64.b64decode(content_md5, validate=True)
+    except binascii.Error:
+        return None
 
 
-def make_post_request(
-    api_key: str, parameters: Dict[str, Any]
+async def fetch_image(
+    session: aiohttp.ClientSession, url: str, full_path: Path
+) -> bool:
+    """
+    Stream an image from a URL to full_path, hashing it on the way. Return
+    False if the result does not match the digest advertised by the server.
+    """
+    async with session.get(
+        url,
+        timeout=aiohttp.ClientTimeout(
+            sock_connect=REQUESTS_GET_TIMEOUT, sock_read=REQUESTS_GET_TIMEOUT
+        ),
+    ) as response:
+        response.raise_for_status()
+        expected = advertised_md5(response)
+        digest = hashlib.md5(usedforsecurity=False)
+        # Stream the body to disk instead of buffering the whole image.
+        # File operations run in a worker thread so other generations keep
+        # going.
+        f = await asyncio.to_thread(full_path.open, "wb")
+        try:
+            async for chunk in response.content.iter_chunked(
+                DOWNLOAD_CHUNK_SIZE
+            ):
+                digest.update(chunk)
+                await asyncio.to_thread(f.write, chunk)
+        finally:
+            await asyncio.to_thread(f.close)
+    return expected is None or digest.digest() == expected
+
+
+async def download_image(
+    session: aiohttp.ClientSession, url: str, filepath: Path
+) -> bool:
+    """
+    Download an image from a URL and save it as JPEG within the output
+    directory. A corrupt download, or one that failed with a server,
+    rate-limit or connection error, is deleted and retried with backoff.
+    Return whether the image was saved.
+    """
+    # Construct the full path by joining OUTPUT_DIR_NAME and filepath
+    full_path = Path(OUTPUT_DIR_NAME) / filepath
+    delay = DOWNLOAD_RETRY_DELAY
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        retryable = True
+        try:
+            if await fetch_image(session, url, full_path):
+                print(f"Image saved to {OUTPUT_DIR_NAME}/{filepath.name}")
+                return True
+            print(f"Checksum mismatch in image downloaded from {url}")
+        except aiohttp.ClientResponseError as e:
+            # Client errors other than rate limiting, e.g. an expired signed
+            # URL, will not go away
+            retryable = e.status >= 500 or e.status == 429
+            print(f"Failed to download image from {url}: {e}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Failed to download image from {url}: {e}")
+        await asyncio.to_thread(full_path.unlink, missing_ok=True)
+        if not retryable:
+            break
+        if attempt < DOWNLOAD_ATTEMPTS:
+            await asyncio.sleep(delay)
+            delay *= 2
+    return False
+
+
+async def make_post_request(
+    session: aiohttp.ClientSession, api_key: str, body: bytes
 ) -> Dict[str, Any]:
     """
-    Make a POST request to the FLUX.1 API and return the response JSON.
+    Make a POST request to the FLUX.1 API with the JSON-encoded parameters
+    and return the response JSON.
     """
     try:
-        response = requests.post(
+        async with session.post(
             "https://api.bfl.ml/v1/image",
             headers={
                 "accept": "application/json",
                 "x-key": api_key,
                 "Content-Type": "application/json",
             },
-            json=parameters,
-            timeout=REQUESTS_GET_TIMEOUT,
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        sys.exit(f"Error during POST request: {e}")
-
-
-def poll_for_result(
-    api_key: str, request_id: str, verbose: bool
+            data=body,
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=REQUESTS_GET_TIMEOUT,
+                sock_read=REQUESTS_GET_TIMEOUT,
+            ),
+        ) as response:
+            response.raise_for_status()
+            return await response.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise GenerationError(f"Error during POST request: {e}") from e
+
+
+async def poll_for_result(
+    session: aiohttp.ClientSession,
+    api_key: str,
+    request_id: str,
+    verbose: bool,
 ) -> Dict[str, Any]:
     """
-    Poll the FLUX.1 API for the result using the request ID.
+    Poll the FLUX.1 API for the result using the request ID. Raise
+    GenerationError when the generation ends without a result, e.g. because
+    the prompt was moderated.
+
+    Each GET asks the server to hold the request until the result is ready
+    (long polling), so a new request is issued immediately after the previous
+    one returns.  Servers that ignore the wait parameter and answer at once
+    are polled with an exponential backoff (plus jitter) which is reset
+    whenever the reported status changes.
     """
+    loop = asyncio.get_running_loop()
+    delay = POLLING_INITIAL_DELAY
+    last_status = None
     while True:
-        time.sleep(POLLING_SLEEP_INTERVAL)
+        started = loop.time()
         try:
-            result_response = requests.get(
+            async with session.get(
                 "https://api.bfl.ml/v1/get_result",
                 headers={
                     "accept": "application/json",
                     "x-key": api_key,
                 },
-                params={"id": request_id},
-                timeout=REQUESTS_GET_TIMEOUT,
-            )
-            result_response.raise_for_status()
-            result_data = result_response.json()
-        except requests.RequestException as e:
-            print(f"Error during GET request: {e}")
+                params={"id": request_id, "wait": LONG_POLL_WAIT},
+                timeout=aiohttp.ClientTimeout(total=LONG_POLL_TIMEOUT),
+            ) as result_response:
+                result_response.raise_for_status()
+                result_data = await result_response.json()
+        except asyncio.TimeoutError:
+            # The server held the request past our deadline; reissue it
             continue
+        except aiohttp.ClientResponseError as e:
+            # Client errors other than rate limiting will not go away
+            if 400 <= e.status < 500 and e.status != 429:
+                raise GenerationError(f"Error during GET request: {e}") from e
+            print(f"Error during GET request: {e}")
+        except aiohttp.ClientError as e:
+            print(f"Error during GET request: {e}")
+        else:
+            if verbose:
+                print("Result Response:")
+                print(json.dumps(result_data, indent=4, ensure_ascii=False))
+
+            status = result_data.get("status")
+            if status == "Ready":
+                print("Result is ready.")
+                return result_data
 
-        if verbose:
-            print("Result Response:")
-            print(json.dumps(result_data, indent=4, ensure_ascii=False))
+            if status not in POLLING_PENDING_STATUSES:
+                raise GenerationError(
+                    f"Generation ended with status: {status}"
+                )
 
-        if result_data.get("status") == "Ready":
-            print("Result is ready.")
-            return result_data
+            print(f"Status: {status}")
+            if status != last_status:
+                delay = POLLING_INITIAL_DELAY
+                last_status = status
 
-        print(f"Status: {result_data.get('status')}")
+        remaining = delay - (loop.time() - started)
+        if remaining > 0:
+            await asyncio.sleep(remaining + random.uniform(0, delay * 0.1))
+        delay = min(delay * 2, POLLING_MAX_DELAY)
 
 
-def main() -> None:  # pylint: disable=too-many-locals
+def is_fixed_seed(seed_arg: str) -> bool:
     """
-    Main function to execute the image generation process.
+    Return whether the --seed argument gives a fixed seed. Only results of
+    fixed seeds are cached, as random seeds practically never repeat.
     """
+    return seed_arg.lower() not in ("rand", "null")
 
-    # Define default parameters
-    defaults = {
-        "width": 1024,
-        "height": 1024,
-        "variant": "flux.1-pro",
-        "steps": 25,
-        "prompt_upsampling": False,
-        "seed": "rand",
-        "guidance": 2.5,
-        "safety_tolerance": 2,
-        "interval": 2.0,
-    }
-
-    # Parse arguments
-    args = parse_arguments(defaults)
-
-    # Load API key
-    api_key = load_api_key()
-
-    # Get prompt from standard input
-    prompt = get_prompt()
 
-    # Handle seed parameter
-    seed_input = args.seed.lower()
+def resolve_seed(seed_arg: str, index: int) -> Optional[int]:
+    """
+    Resolve the --seed argument into the seed of the index-th image. A fixed
+    seed is offset by the index so that every image of a batch differs.
+    Raise ValueError if the resulting seed does not fit in 64 bits.
+    """
+    seed_input = seed_arg.lower()
     if seed_input == "rand":
-        seed = random.randint(0, 2**64 - 1)
-    elif seed_input == "null":
-        seed = None
-    else:
-        try:
-            seed = int(args.seed)
-        except ValueError:
-            sys.exit("Error: --seed must be an integer, 'rand', or 'null'.")
+        return secrets.randbits(64)
+    if seed_input == "null":
+        return None
+    seed = int(seed_arg) + index
+    if not 0 <= seed < 2**64:
+        raise ValueError(f"Seed out of range: {seed}")
+    return seed
 
-    # Prepare parameters
-    parameters = {
+
+def build_parameters(
+    prompt: str, options: argparse.Namespace, seed: Optional[int]
+) -> Dict[str, Any]:
+    """
+    Build the request parameters sent to the FLUX.1 API.
+    """
+    return {
         "prompt": prompt,
-        "width": args.width,
-        "height": args.height,
-        "variant": args.variant,
-        "steps": args.steps,
-        "prompt_upsampling": args.prompt_upsampling,
+        "width": options.width,
+        "height": options.height,
+        "variant": options.variant,
+        "steps": options.steps,
+        "prompt_upsampling": options.prompt_upsampling,
         "seed": seed,
-        "guidance": args.guidance,
-        "safety_tolerance": args.safety_tolerance,
-        "interval": args.interval,
+        "guidance": options.guidance,
+        "safety_tolerance": options.safety_tolerance,
+        "interval": options.interval,
     }
 
-    # Create output directory
-    output_dir = Path.cwd() / OUTPUT_DIR_NAME
-    create_output_directory(output_dir)
 
-    # Generate timestamp
-    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+async def generate_one(  # pylint: disable=too-many-locals,too-many-arguments
+    session: aiohttp.ClientSession,
+    api_key: str,
+    parameters: Dict[str, Any],
+    stamp: str,
+    args: argparse.Namespace,
+    *,
+    webhook_url: Optional[str] = None,
+    webhook_event: Optional[asyncio.Event] = None,
+    use_cache: bool = False,
+) -> None:
+    """
+    Run a single generation: save the request, submit it, poll for the
+    result and download the image. Files are named after the given stamp.
+    With use_cache, an image previously generated from identical parameters
+    is reused instead of being generated again, and a new image is added to
+    the cache.
+
+    When webhook_url is given, the API is asked to call it back on
+    completion, and webhook_event is expected to be set when that happens.
+    The callback only ends the wait: the result itself is always fetched
+    through the authenticated get_result API.
+    """
+    output_dir = Path.cwd() / OUTPUT_DIR_NAME
 
     # Define filenames
-    request_filename = generate_filename("request", timestamp, "json")
-    result_filename = generate_filename("result", timestamp, "json")
-    image_filename = generate_filename("result", timestamp, "jpg")
+    request_filename = generate_filename("request", stamp, "json")
+    result_filename = generate_filename("result", stamp, "json")
+    image_filename = generate_filename("result", stamp, "jpg")
+
+    # The parameters are serialized once; the same bytes are saved, sent as
+    # the POST body and hashed for the cache key. Only a webhook job needs a
+    # second document, as its per-job callback URL must not be part of the
+    # cache key.
+    request_body = encode_json(parameters)
+    cached_image = cache_path(request_body) if use_cache else None
+    if webhook_url is not None:
+        request_body = encode_json({**parameters, "webhook_url": webhook_url})
 
     # Save request JSON
     request_filepath = output_dir / request_filename
-    save_json(parameters, request_filepath)
+    await asyncio.to_thread(request_filepath.write_bytes, request_body)
 
     if args.verbose:
         print("Request JSON:")
-        print(json.dumps(parameters, indent=4, ensure_ascii=False))
+        print(request_body.decode("utf-8"))
+
+    if cached_image is not None:
+        if await asyncio.to_thread(cached_image.exists):
+            await asyncio.to_thread(
+                link_or_copy, cached_image, output_dir / image_filename
+            )
+            print(
+                "Image reused from cache and saved to "
+                f"{OUTPUT_DIR_NAME}/{image_filename}"
+            )
+            return
 
     # Make POST request
-    request_response = make_post_request(api_key, parameters)
+    request_response = await make_post_request(session, api_key, request_body)
 
     if args.verbose:
         print("Response from POST request:")
@@ -342,22 +713,288 @@ def main() -> None:  # pylint: disable=too-many-locals
 
     request_id = request_response.get("id")
     if not request_id:
-        sys.exit("Error: 'id' not found in the POST response.")
+        raise GenerationError("Error: 'id' not found in the POST response.")
 
-    # Polling for result
-    result_data = poll_for_result(api_key, request_id, args.verbose)
+    # Wait for the webhook, if any, before polling for the result
+    if webhook_event is not None:
+        try:
+            await asyncio.wait_for(webhook_event.wait(), WEBHOOK_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("No webhook received; polling for the result.")
+    result_data = await poll_for_result(
+        session, api_key, request_id, args.verbose
+    )
 
     # Save result JSON
     result_filepath = output_dir / result_filename
-    save_json(result_data, result_filepath)
+    await asyncio.to_thread(save_json, result_data, result_filepath)
 
     # Extract image URL and download
     sample_url = result_data.get("result", {}).get("sample")
     if sample_url:
-        download_image(sample_url, Path(image_filename))
+        saved = await download_image(session, sample_url, Path(image_filename))
+        if not saved:
+            raise GenerationError("Error: Image could not be downloaded.")
+        if cached_image:
+            await asyncio.to_thread(
+                link_or_copy, output_dir / image_filename, cached_image
+            )
     else:
         print("No image URL found in the result.")
 
 
+def coerce_option(value: Any, kind: type) -> Any:
+    """
+    Convert a JSON value given for an option to the option's type. Raise
+    ValueError if it is not a valid value of that type.
+    """
+    if kind is bool:
+        if not isinstance(value, bool):
+            raise ValueError(f"Not a boolean: {value!r}")
+        return value
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"Not a {kind.__name__}: {value!r}")
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ValueError(f"Not a finite number: {value!r}")
+    if kind is int and isinstance(value, float) and not value.is_integer():
+        raise ValueError(f"Not an integer: {value!r}")
+    converted = kind(value)
+    if isinstance(converted, float) and not math.isfinite(converted):
+        raise ValueError(f"Not a finite number: {value!r}")
+    return converted
+
+
+def job_parameters(
+    body: Any, args: argparse.Namespace
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    Build the request parameters of a job submitted to the server, taking
+    any JOB_OPTION_NAMES in the body over the command-line arguments. Also
+    return whether the job has a fixed seed.
+    """
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="Body must be a JSON object.")
+    prompt = body.get("prompt")
+    if not isinstance(prompt, str) or not prompt.strip():
+        raise web.HTTPBadRequest(text="'prompt' must be a non-empty string.")
+    prompt = prompt.strip()
+
+    options = argparse.Namespace(**vars(args))
+    for name, kind in JOB_OPTION_TYPES.items():
+        if name not in body:
+            continue
+        value = body[name]
+        if name == "seed" and value is None:
+            # A null seed is spelled "null" on the command line
+            value = "null"
+        try:
+            setattr(options, name, coerce_option(value, kind))
+        except ValueError as e:
+            raise web.HTTPBadRequest(
+                text=f"'{name}' must be a valid {kind.__name__}."
+            ) from e
+    try:
+        seed = resolve_seed(options.seed, 0)
+    except ValueError as e:
+        raise web.HTTPBadRequest(
+            text=(
+                "'seed' must be an integer from 0 to 2**64 - 1, 'rand', or "
+                "'null'."
+            )
+        ) from e
+    return build_parameters(prompt, options, seed), is_fixed_seed(options.seed)
+
+
+def normalize_public_url(public_url: Optional[str]) -> str:
+    """
+    Validate the --public_url argument and strip any trailing slash, so that
+    callback URLs built from it never contain "//". Return an empty string
+    if it was not given.
+    """
+    if not public_url:
+        return ""
+    parts = urlsplit(public_url)
+    if parts.scheme not in ("http", "https") or not parts.netloc:
+        sys.exit("Error: --public_url must be an absolute http(s) URL.")
+    return public_url.rstrip("/")
+
+
+async def serve(args: argparse.Namespace, api_key: str) -> None:
+    """
+    Run a long-lived HTTP server that accepts generation jobs.
+
+    POST /generate takes a JSON object with a "prompt" and optionally any of
+    JOB_OPTION_NAMES, starts the generation in the background and returns
+    its job ID at once. If the FLUX_SERVER_TOKEN environment variable is
+    set, requests must carry it as "Authorization: Bearer <token>".
+
+    With --public_url, the FLUX.1 API reports completion to
+    POST /callback/{token}, where token is a secret random string made for
+    each job, instead of the job being polled until then.
+    """
+    callbacks: Dict[str, asyncio.Event] = {}
+    tasks: Set["asyncio.Task[None]"] = set()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    server_token = os.environ.get("FLUX_SERVER_TOKEN")
+    public_url = normalize_public_url(args.public_url)
+    if public_url and not server_token:
+        print(
+            "Warning: FLUX_SERVER_TOKEN is not set, so anyone who can reach "
+            "/generate can spend your API credits. Expose only /callback/ "
+            "publicly.",
+            file=sys.stderr,
+        )
+
+    async def run_job(
+        parameters: Dict[str, Any], job_id: str, fixed_seed: bool
+    ) -> None:
+        webhook_url = None
+        webhook_event = None
+        callback_token = secrets.token_urlsafe(32)
+        if public_url:
+            webhook_url = f"{public_url}/callback/{callback_token}"
+            webhook_event = callbacks[callback_token] = asyncio.Event()
+        try:
+            async with semaphore:
+                await generate_one(
+                    session,
+                    api_key,
+                    parameters,
+                    job_id,
+                    args,
+                    webhook_url=webhook_url,
+                    webhook_event=webhook_event,
+                    use_cache=fixed_seed and not args.no_cache,
+                )
+        except GenerationError as e:
+            print(f"Job {job_id}: {e}", file=sys.stderr)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # Nobody awaits the task, so report the failure here
+            print(f"Job {job_id} failed: {e!r}", file=sys.stderr)
+        finally:
+            callbacks.pop(callback_token, None)
+
+    async def handle_generate(request: web.Request) -> web.Response:
+        if server_token and not secrets.compare_digest(
+            request.headers.get("Authorization", "").encode("utf-8"),
+            f"Bearer {server_token}".encode("utf-8"),
+        ):
+            raise web.HTTPUnauthorized(text="Invalid or missing token.")
+        try:
+            body = await request.json()
+        except ValueError as e:
+            # Invalid JSON as well as a body that is not UTF-8
+            raise web.HTTPBadRequest(text="Body must be a JSON object.") from e
+        parameters, fixed_seed = job_parameters(body, args)
+
+        job_id = generate_stamp()
+        task = asyncio.create_task(run_job(parameters, job_id, fixed_seed))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return web.json_response({"id": job_id}, status=202)
+
+    async def handle_callback(request: web.Request) -> web.Response:
+        event = callbacks.get(request.match_info["token"])
+        if event is None:
+            raise web.HTTPNotFound()
+        # The body is not trusted; the job fetches the result from the API
+        event.set()
+        return web.json_response({"status": "ok"})
+
+    app = web.Application()
+    app.router.add_post("/generate", handle_generate)
+    app.router.add_post("/callback/{token}", handle_callback)
+
+    # A single session is shared by all jobs for the life of the server
+    async with create_session(args.concurrency) as session:
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, args.host, args.port).start()
+            print(f"Serving on http://{args.host}:{args.port}")
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+
+async def main() -> None:
+    """
+    Main function to execute the image generation process.
+    """
+
+    # Parse arguments
+    args = parse_arguments()
+    if args.batch < 1 or args.concurrency < 1:
+        sys.exit("Error: --batch and --concurrency must be at least 1.")
+
+    # Load API key
+    api_key = load_api_key()
+
+    # Create output directory
+    output_dir = Path.cwd() / OUTPUT_DIR_NAME
+    create_output_directory(output_dir)
+
+    if args.serve:
+        await serve(args, api_key)
+        return
+
+    # Get prompts from the batch file, or a single one from standard input
+    if args.batch_file:
+        prompts = read_prompts(args.batch_file)
+    else:
+        prompts = [get_prompt()]
+
+    # Prepare parameters, one set per image. The API has no batch endpoint,
+    # so every image is submitted on its own over the shared session.
+    try:
+        params_list: List[Dict[str, Any]] = [
+            build_parameters(prompt, args, resolve_seed(args.seed, index))
+            for prompt in prompts
+            for index in range(args.batch)
+        ]
+    except ValueError:
+        sys.exit(
+            "Error: --seed must be an integer from 0 to 2**64 - 1, 'rand', "
+            "or 'null'."
+        )
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    use_cache = is_fixed_seed(args.seed) and not args.no_cache
+
+    async def limited(parameters: Dict[str, Any]) -> None:
+        async with semaphore:
+            await generate_one(
+                session,
+                api_key,
+                parameters,
+                generate_stamp(),
+                args,
+                use_cache=use_cache,
+            )
+
+    # A single session is shared by all POST, polling and download calls
+    async with create_session(args.concurrency) as session:
+        results = await asyncio.gather(
+            *(limited(parameters) for parameters in params_list),
+            return_exceptions=True,
+        )
+
+    failures = [result for result in results if isinstance(result, Exception)]
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    if failures:
+        sys.exit(
+            f"Error: {len(failures)} of {len(results)} generations failed."
+        )
+
+
 if __name__ == "__main__":
-    main()
+    # uvloop is a faster drop-in event loop, used when installed. uvloop.run
+    # only exists in uvloop 0.18 and later; older versions install their
+    # event loop policy instead.
+    if uvloop is not None and getattr(uvloop, "run", None) is not None:
+        uvloop.run(main())
+    else:
+        if uvloop is not None:
+            uvloop.install()
+        asyncio.run(main())